@@ -2,17 +2,425 @@
 This does not work with "multi-embedding" representations like CP Word or Octuple.
 """
 
-from typing import List, Dict, Union, Any, Type
+from typing import List, Tuple, Dict, Set, Union, Any, Type, Callable, Iterable, Iterator, Optional
 from pathlib import Path, PurePath
 import json
 from random import choices
-
+from collections import Counter
+from itertools import islice
+from heapq import heapify, heappush, heappop
+from bisect import bisect_right
+from math import ceil
+from functools import partial
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 from miditoolkit import MidiFile
 from tqdm import tqdm
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from .midi_tokenizer_base import MIDITokenizer, Event, Vocabulary
 
 
+_MERGED = -1  # tombstone value of the tokens merged within their previous one during BPE learning
+_SEPARATOR = -2  # value separating the words in the buffer used during BPE learning
+# Pairs of successive tokens are packed as single ints: (tok1 << _PAIR_SHIFT) | tok2
+# as they hash faster than tuples. Tokens hence need to be positive and lower than 2^32.
+_PAIR_SHIFT = 32
+_PAIR_MASK = (1 << _PAIR_SHIFT) - 1
+
+
+def _pack_pair(token_1: int, token_2: int) -> int:
+    r"""Packs a pair of successive tokens into a single int.
+
+    :param token_1: first token
+    :param token_2: second token
+    :return: the packed pair
+    """
+    return token_1 << _PAIR_SHIFT | token_2
+
+
+def _unpack_pair(pair: int) -> Tuple[int, int]:
+    r"""Unpacks a pair of successive tokens packed with _pack_pair.
+
+    :param pair: the packed pair
+    :return: the two tokens of the pair
+    """
+    return pair >> _PAIR_SHIFT, pair & _PAIR_MASK
+
+
+def _map(function: Callable, *iterables: Iterable, nb_processes: int = 1, chunksize: int = 1) -> Iterator:
+    r"""Maps a function to iterables, with a pool of processes if nb_processes is higher than 1.
+    The results are yielded in order.
+
+    :param function: function to apply, has to be picklable (defined at module level) if nb_processes > 1
+    :param iterables: iterables of the arguments to give to the function
+    :param nb_processes: number of processes to use (default: 1)
+    :param chunksize: number of items sent at once to each process (default: 1)
+    :return: the results of the function
+    """
+    if nb_processes > 1:
+        with ProcessPoolExecutor(nb_processes) as executor:
+            yield from executor.map(function, *iterables, chunksize=chunksize)
+    else:
+        yield from map(function, *iterables)
+
+
+def _load_json(path: Union[str, Path, PurePath]) -> Any:
+    r"""Loads a JSON file (tokens or parameters), using orjson if it is installed.
+
+    :param path: path of the file to load
+    :return: the loaded object
+    """
+    if orjson is not None:
+        return orjson.loads(Path(path).read_bytes())
+    with open(path) as file:
+        return json.load(file)
+
+
+def _save_json(obj: Any, path: Union[str, Path, PurePath], indent: bool = False):
+    r"""Saves an object as a JSON file, using orjson if it is installed.
+    The file is written the same way with or without orjson. Non-string keys of
+    dictionaries (e.g. tokens) are saved as strings.
+
+    :param obj: object to save
+    :param path: path of the file to save
+    :param indent: will indent the file with 2 spaces, otherwise it is saved compact (default: False)
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        Path(path).write_bytes(orjson.dumps(obj, option=option))
+    else:
+        with open(path, 'w') as outfile:
+            json.dump(obj, outfile, ensure_ascii=False, **({'indent': 2} if indent else {'separators': (',', ':')}))
+
+
+def _split_track(track: List[int], bar_tokens: Set[int]) -> List[Tuple[int, ...]]:
+    r"""Splits a track into "words", i.e. sequences of tokens beginning by a Bar token.
+    If the tokenizer has no Bar token, the track is returned as a single word.
+
+    :param track: sequence of tokens to split
+    :param bar_tokens: Bar tokens of the vocabulary
+    :return: the words of the track
+    """
+    words = []
+    start = 0
+    for i, token in enumerate(track):
+        if token in bar_tokens and i > start:
+            words.append(tuple(track[start:i]))
+            start = i
+    if start < len(track):
+        words.append(tuple(track[start:]))
+    return words
+
+
+def _count_words(bar_tokens: Set[int], files_paths: List[Path]) -> Tuple[Counter, List[int]]:
+    r"""Loads token files, and counts the words (see _split_track) of their tracks.
+    Only these counts are returned, so that little data is sent back when it is run by another process.
+
+    :param bar_tokens: Bar tokens of the vocabulary
+    :param files_paths: paths of the token files to load
+    :return: the number of occurrences of each unique word, and the lengths of the tracks
+    """
+    words_freq = Counter()
+    lengths = []
+    for file_path in files_paths:
+        for track in _load_json(file_path)['tokens']:
+            words_freq.update(_split_track(track, bar_tokens))
+            lengths.append(len(track))
+    return words_freq, lengths
+
+
+def _words_to_buffer(words: List[Tuple[int, ...]]) -> Tuple[array, List[int]]:
+    r"""Concatenates words into a single flat buffer, in which they are separated by _SEPARATOR values.
+    The buffer begins and ends by a separator, so that the neighbours of any token can be read without
+    checking the boundaries of its word.
+    It is stored as an array of C ints, taking 4 bytes per token instead of a pointer to an int object.
+
+    :param words: words to concatenate
+    :return: the buffer, and the position of the first token of each word in it
+    """
+    buffer = array('i', [_SEPARATOR])
+    words_start = []
+    for word in words:
+        words_start.append(len(buffer))
+        buffer.extend(word)
+        buffer.append(_SEPARATOR)
+    return buffer, words_start
+
+
+def _count_pairs(words: List[Tuple[int, ...]], words_start: List[int], words_freq: List[int]) \
+        -> Tuple[Dict[int, int], Dict[int, List[int]]]:
+    r"""Counts the occurrences of the successions of two tokens of words, weighted by the
+    frequencies of the words, and registers their positions in the buffer.
+    The pairs are packed with _pack_pair.
+
+    :param words: words to analyze
+    :param words_start: position of the first token of each word in the buffer
+    :param words_freq: number of times each word appears in the dataset
+    :return: the number of occurrences of each pair of successive tokens, and their positions
+    """
+    occurrences = {}
+    positions = {}
+    for word, start, freq in zip(words, words_start, words_freq):
+        for i, (token_1, token_2) in enumerate(zip(word, islice(word, 1, None)), start):
+            pair = token_1 << _PAIR_SHIFT | token_2
+            occurrences[pair] = occurrences.get(pair, 0) + freq
+            try:
+                positions[pair].append(i)
+            except KeyError:
+                positions[pair] = [i]
+    return occurrences, positions
+
+
+def _merge_pair(buffer: array, words_start: List[int], words_freq: List[int],
+                occurrences: Dict[int, int], positions: Dict[int, Set[int]], heap: List[Tuple[int, int]],
+                repeated_counts: Dict[int, int], pair: int, new_token: int):
+    r"""Merges every occurrence of a pair of successive tokens into a new BPE token, and updates the
+    occurrences / positions of the neighbouring pairs accordingly.
+    The second token of each merged pair is replaced by a tombstone (_MERGED), so that the positions
+    of the other tokens remain valid. The buffer has to be compacted once the learning is done.
+
+    :param buffer: flat buffer of the words being encoded (see _words_to_buffer), modified in place
+    :param words_start: position of the first token of each word in the buffer
+    :param words_freq: number of times each word appears in the dataset
+    :param occurrences: number of occurrences of each (packed) pair of successive tokens
+    :param positions: positions in the buffer of the first token of each (packed) pair of successive tokens
+    :param heap: heap of the pairs by number of occurrences (see _pop_most_frequent_pair), the pairs
+                which number of occurrences increases are pushed into it
+    :param repeated_counts: cached non-overlapping occurrences of pairs of identical tokens (see
+                _count_repeated_pair), the entries of the pairs which positions change are removed
+    :param pair: the (packed) pair of tokens to merge
+    :param new_token: the BPE token replacing the pair
+    """
+    def decrease(pair_: int, position: int, freq: int):
+        repeated_counts.pop(pair_, None)
+        occurrences[pair_] -= freq
+        positions[pair_].discard(position)
+        if occurrences[pair_] == 0:
+            del occurrences[pair_]
+            del positions[pair_]
+
+    def increase(pair_: int, position: int, freq: int):
+        repeated_counts.pop(pair_, None)
+        try:
+            occurrences[pair_] += freq
+            positions[pair_].add(position)
+        except KeyError:
+            occurrences[pair_] = freq
+            positions[pair_] = {position}
+        heappush(heap, (-occurrences[pair_], pair_))
+
+    token_1, token_2 = _unpack_pair(pair)
+    new_token_shifted = new_token << _PAIR_SHIFT
+    pair_positions = positions[pair]
+    for i in sorted(pair_positions):  # in order, as successive identical tokens overlap
+        if i not in pair_positions:  # already merged with the previous one
+            continue
+        freq = words_freq[bisect_right(words_start, i) - 1]
+        j = i + 1  # position of the second token of the pair
+        while buffer[j] == _MERGED:
+            j += 1
+        h = i - 1  # position of the previous token
+        while buffer[h] == _MERGED:
+            h -= 1
+        k = j + 1  # position of the next token
+        while buffer[k] == _MERGED:
+            k += 1
+
+        occurrences[pair] -= freq
+        pair_positions.discard(i)
+        if buffer[h] != _SEPARATOR:
+            decrease(buffer[h] << _PAIR_SHIFT | token_1, h, freq)
+            increase(buffer[h] << _PAIR_SHIFT | new_token, h, freq)
+        if buffer[k] != _SEPARATOR:
+            decrease(token_2 << _PAIR_SHIFT | buffer[k], j, freq)
+            increase(new_token_shifted | buffer[k], i, freq)
+        buffer[i] = new_token
+        buffer[j] = _MERGED
+
+    occurrences.pop(pair, None)  # could have already been removed by decrease (successive identical tokens)
+    positions.pop(pair, None)
+    repeated_counts.pop(pair, None)
+
+
+def _count_repeated_pair(buffer: array, words_start: List[int], words_freq: List[int],
+                         positions: Dict[int, Set[int]], repeated_counts: Dict[int, int], pair: int) -> int:
+    r"""Counts the number of times a pair of two identical tokens can actually be merged, i.e. the
+    number of its non-overlapping occurrences. A run of n repeated tokens contains n - 1 of
+    these pairs, but only n // 2 of them can be merged.
+    The count is cached in repeated_counts until the positions of the pair change (see _merge_pair),
+    as a merge can push many outdated heap entries for a same pair, which would each require to count it.
+
+    :param buffer: flat buffer of the words being encoded (see _words_to_buffer)
+    :param words_start: position of the first token of each word in the buffer
+    :param words_freq: number of times each word appears in the dataset
+    :param positions: positions in the buffer of the first token of each (packed) pair of successive tokens
+    :param repeated_counts: cached non-overlapping occurrences of pairs of identical tokens
+    :param pair: the (packed) pair of identical tokens to count
+    :return: the number of non-overlapping occurrences of the pair
+    """
+    if pair in repeated_counts:
+        return repeated_counts[pair]
+    count = 0
+    last_merged = -1  # position of the second token of the last pair that would be merged
+    for i in sorted(positions.get(pair, ())):
+        if i == last_merged:  # overlaps with the previous pair
+            continue
+        last_merged = i + 1
+        while buffer[last_merged] == _MERGED:
+            last_merged += 1
+        count += words_freq[bisect_right(words_start, i) - 1]
+    repeated_counts[pair] = count
+    return count
+
+
+def _pop_most_frequent_pair(heap: List[Tuple[int, int]], occurrences: Dict[int, int],
+                            count_repeated_pair: Callable[[int], int]) -> Optional[int]:
+    r"""Pops the most recurrent pair of successive tokens from a heap of (-nb_occurrences, pair) entries.
+    The entries are not updated when the occurrences of a pair change, a new one is pushed instead.
+    Outdated entries are hence discarded when popped, or pushed back with the current number of
+    occurrences of their pair if it decreased since.
+    The occurrences of pairs of identical tokens are counted with overlaps, which is needed to update
+    them incrementally. Their entries are hence upper bounds, which are checked against their number
+    of non-overlapping occurrences when popped (and pushed back with it if lower).
+
+    :param heap: heap of (-nb_occurrences, pair)
+    :param occurrences: current number of occurrences of each (packed) pair of successive tokens
+    :param count_repeated_pair: function returning the number of non-overlapping occurrences of a pair
+                of identical tokens (see _count_repeated_pair)
+    :return: the (packed) pair with the highest number of occurrences, None if there is no pair left
+    """
+    while len(heap) > 0:
+        neg_count, pair = heappop(heap)
+        count = occurrences.get(pair, 0)
+        if count > 0 and pair >> _PAIR_SHIFT == pair & _PAIR_MASK:
+            count = count_repeated_pair(pair)
+        if count == -neg_count:
+            return pair
+        elif 0 < count < -neg_count:
+            heappush(heap, (-count, pair))
+    return None
+
+
+def _pop_most_frequent_pairs(heap: List[Tuple[int, int]], occurrences: Dict[int, int],
+                             count_repeated_pair: Callable[[int], int], nb_pairs: int) -> List[int]:
+    r"""Pops the most recurrent pairs of successive tokens that do not share any token, so that they
+    can be merged successively without affecting the occurrences of each other.
+    Pairs sharing a token with a more recurrent one are left in the heap.
+
+    :param heap: heap of (-nb_occurrences, pair) (see _pop_most_frequent_pair)
+    :param occurrences: current number of occurrences of each (packed) pair of successive tokens
+    :param count_repeated_pair: function returning the number of non-overlapping occurrences of a pair
+                of identical tokens (see _count_repeated_pair)
+    :param nb_pairs: maximum number of pairs to pop
+    :return: the (packed) pairs, by decreasing number of occurrences
+    """
+    pairs, discarded = [], []
+    pairs_tokens = set()
+    while len(pairs) < nb_pairs:
+        pair = _pop_most_frequent_pair(heap, occurrences, count_repeated_pair)
+        if pair is None:
+            break
+        tokens = _unpack_pair(pair)
+        if pairs_tokens.isdisjoint(tokens):
+            pairs.append(pair)
+            pairs_tokens.update(tokens)
+        else:
+            discarded.append(pair)
+    for pair in discarded:
+        heappush(heap, (-occurrences[pair], pair))
+    return pairs
+
+
+def _compact_buffer(buffer: array, words_start: List[int]) -> Tuple[array, List[int]]:
+    r"""Removes the merged (tombstone) tokens of a buffer. This is done with numpy (without copying
+    the buffer), the new position of each token being the number of non-merged tokens before it.
+
+    :param buffer: flat buffer of words (see _words_to_buffer)
+    :param words_start: position of the first token of each word in the buffer
+    :return: the compacted buffer, and the new position of the first token of each word
+    """
+    buffer_np = np.frombuffer(buffer, dtype=np.intc)
+    alive = buffer_np != _MERGED
+    new_positions = np.cumsum(alive) - 1
+    compacted = array('i')
+    compacted.frombytes(buffer_np[alive].tobytes())
+    return compacted, new_positions[words_start].tolist()
+
+
+def _total_length(buffer: array, words_start: List[int], words_freq: List[int]) -> int:
+    r"""Computes the total number of tokens of the dataset from the buffer of its unique words,
+    i.e. the sum of the lengths of the words (without the merged tokens) times their frequencies.
+
+    :param buffer: flat buffer of words (see _words_to_buffer)
+    :param words_start: position of the first token of each word in the buffer
+    :param words_freq: number of times each word appears in the dataset
+    :return: the total number of tokens
+    """
+    buffer, words_start = _compact_buffer(buffer, words_start)
+    words_end = words_start[1:] + [len(buffer)]
+    return sum((end - start - 1) * freq for start, end, freq in zip(words_start, words_end, words_freq))
+
+
+def _apply_merges(tokens: List[int], merges: Dict[int, int]) -> List[int]:
+    r"""Applies BPE merges to a sequence of tokens.
+    The pair of successive tokens with the lowest BPE token is merged first, and the successive pairs
+    of equal priority are merged from left to right, resulting in the same sequence as when the BPE
+    was learned. As BPE tokens are created in increasing order, their value is also their priority.
+    The pairs to merge are kept in a heap, and the tokens in a linked list (the next position of each one),
+    so that only the neighbours of a merged pair need to be updated after each merge.
+
+    :param tokens: sequence of tokens to convert
+    :param merges: the merges, as a dictionary of the form packed_pair: bpe_token (see _pack_pair)
+    :return: the sequence of tokens with BPE
+    """
+    tokens = list(tokens)
+    next_ = list(range(1, len(tokens) + 1))  # position of the next token
+    prev_ = list(range(-1, len(tokens) - 1))  # position of the previous token
+    pairs = (token_1 << _PAIR_SHIFT | token_2 for token_1, token_2 in zip(tokens, islice(tokens, 1, None)))
+    heap = [(merges[pair], i) for i, pair in enumerate(pairs) if pair in merges]
+    heapify(heap)
+    while len(heap) > 0:
+        new_token, i = heappop(heap)
+        j = next_[i]
+        # Checks the pair is still valid, i.e. that none of the tokens has been merged since it was pushed
+        if tokens[i] == _MERGED or j >= len(tokens) or merges.get(tokens[i] << _PAIR_SHIFT | tokens[j]) != new_token:
+            continue
+        tokens[i] = new_token
+        tokens[j] = _MERGED
+        k = next_[i] = next_[j]
+        if k < len(tokens):
+            prev_[k] = i
+            pair = new_token << _PAIR_SHIFT | tokens[k]
+            if pair in merges:
+                heappush(heap, (merges[pair], i))
+        h = prev_[i]
+        if h >= 0:
+            pair = tokens[h] << _PAIR_SHIFT | new_token
+            if pair in merges:
+                heappush(heap, (merges[pair], h))
+    return [token for token in tokens if token != _MERGED]
+
+
+def _apply_bpe_to_file(merges: Dict[int, int], file_path: Path, out_path: Path):
+    r"""Loads a token file, applies BPE to its tracks and saves the result.
+    Only the merges are given (and pickled when using several processes), not the tokenizer.
+
+    :param merges: merges to apply, as a dictionary of the form packed_pair: bpe_token (see _apply_merges)
+    :param file_path: path of the token file to convert
+    :param out_path: path of the file to save
+    """
+    file = _load_json(file_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    _save_json({'tokens': [_apply_merges(track, merges) for track in file['tokens']],
+                'programs': file.get('programs', [])}, out_path)
+
+
 def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
 
     class BPE(tokenizer):
@@ -22,13 +430,17 @@ def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
             self.has_bpe = False
             super().__init__(*args, **kwargs)
             self.bpe_successions = {}
+            self._bpe_parent_pair = {}  # bpe_token: (tok1, tok2), the two tokens it merges
+            self._bpe_to_children = {}  # bpe_token: (tok1, tok2, tok3...), the non-BPE tokens it is made of
+            self._bpe_merges = {}
             if self.has_bpe:  # loaded from config file
                 self.add_bpe_to_tokens_type_graph()
                 self.set_bpe_tokens_successions()
                 self.vocab.update_token_types_indexes()
 
         def bpe(self, tokens_path: Union[Path, PurePath, str], vocab_size: int, out_dir: Union[Path, PurePath, str],
-                files_lim: int = None, save_converted_samples: bool = False):
+                files_lim: int = None, save_converted_samples: bool = False, nb_processes: int = 1,
+                merges_per_iteration: int = 1) -> Tuple[float, float]:
             r"""Byte Pair Encoding (BPE) method to build the vocabulary.
             This method will build (modify) the vocabulary by analyzing a tokenized dataset to find
             the most recurrent token successions.
@@ -41,56 +453,89 @@ def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
             :param files_lim: limit of token files to use (default: None)
             :param save_converted_samples: will save in out_dir the samples that have been used
                     to create the BPE vocab. Files will keep the same name and relative path (default: True)
+            :param nb_processes: number of processes used to load the token files, count the initial
+                    occurrences of the successions of tokens and save the converted samples (default: 1)
+            :param merges_per_iteration: number of most recurrent successions of tokens merged at each iteration,
+                    among those not sharing any token. Values higher than 1 speed up the learning, but the
+                    merges after the first one of an iteration are chosen without considering the new BPE
+                    tokens created by the previous ones, which can make the sequences slightly longer (default: 1)
+            :return: the mean length of the tracks before and after BPE
             """
             assert vocab_size > len(self.vocab), f'vocab_size ({vocab_size}) need to be higher than the size' \
                                                  f'of the current vocabulary ({len(self.vocab)})'
+            assert merges_per_iteration >= 1, f'merges_per_iteration ({merges_per_iteration}) need to be at least 1'
+            assert isinstance(nb_processes, int) and nb_processes >= 1, \
+                f'nb_processes ({nb_processes}) need to be an integer of at least 1'
             if isinstance(out_dir, str):
                 out_dir = Path(out_dir)
             out_dir.mkdir(parents=True, exist_ok=True)
             files_paths = list(Path(tokens_path).glob('**/*.json'))
             files_paths_bpe = choices(files_paths, k=files_lim) if files_lim is not None else files_paths
-            samples = []
-            samples_paths = []
+            bar_tokens = set(self.vocab.tokens_of_type('Bar')) if 'Bar' in self.tokens_types_graph else set()
+            words_freq = Counter()  # unique words (token sequences, split on Bar tokens): nb of occurrences
             original_lengths = []
 
-            # Loads tokens / samples to analyze
-            for file_path in tqdm(files_paths_bpe, desc='Loading token files'):
-                file = self.load_tokens(file_path)
-                samples.append(file)
-                samples_paths.append(file_path.relative_to(tokens_path))
-                original_lengths += [len(track) for track in file['tokens']]
+            # Loads tokens / samples to analyze, only their unique words are kept in memory
+            # The files are loaded and their words counted by batches, which counts are then added
+            batch_size = min(max(ceil(len(files_paths_bpe) / nb_processes), 1), 16)
+            batches = [files_paths_bpe[i:i + batch_size] for i in range(0, len(files_paths_bpe), batch_size)]
+            batches_counts = _map(partial(_count_words, bar_tokens), batches, nb_processes=nb_processes)
+            pbar = tqdm(total=len(files_paths_bpe), desc='Loading token files')
+            for batch, (batch_words_freq, batch_lengths) in zip(batches, batches_counts):
+                words_freq.update(batch_words_freq)
+                original_lengths += batch_lengths
+                pbar.update(len(batch))
+            pbar.close()
+            words = list(words_freq)
+            buffer, words_start = _words_to_buffer(words)
+            words_freq = list(words_freq.values())
+
+            # Counts the occurrences of successive tokens, and registers where they are located
+            # These are then updated incrementally after each merge, so that only the affected
+            # positions of the dataset are processed (instead of rescanning everything)
+            occurrences = {}  # packed (token_1, token_2): number of occurrences
+            positions = {}  # packed (token_1, token_2): {position in buffer, ...}
+            chunk_size = max(ceil(len(words) / nb_processes), 1)  # the words are split in chunks counted in parallel
+            chunks = [range(i, min(i + chunk_size, len(words))) for i in range(0, len(words), chunk_size)]
+            chunks_counts = _map(_count_pairs, [words[c.start:c.stop] for c in chunks],
+                                 [words_start[c.start:c.stop] for c in chunks],
+                                 [words_freq[c.start:c.stop] for c in chunks], nb_processes=nb_processes)
+            for chunk_occurrences, chunk_positions in chunks_counts:
+                for pair, count in chunk_occurrences.items():
+                    occurrences[pair] = occurrences.get(pair, 0) + count
+                    try:
+                        positions[pair].update(chunk_positions[pair])
+                    except KeyError:
+                        positions[pair] = set(chunk_positions[pair])
+            del words, chunks_counts  # the words are now only stored in the buffer
+
+            heap = [(-count, pair) for pair, count in occurrences.items()]
+            heapify(heap)
+            repeated_counts = {}  # packed (token, token): number of non-overlapping occurrences, when computed
+            count_repeated_pair = partial(_count_repeated_pair, buffer, words_start, words_freq, positions,
+                                          repeated_counts)
 
             # Byte Pair Encoding
             pbar = tqdm(total=vocab_size - len(self.vocab), desc='Learning byte pair encoding')
             while len(self.vocab) < vocab_size:
-                pbar.update(1)
-                occurrences = {}  # count occurrences of successive tokens
-                for sample in samples:
-                    for track in sample['tokens']:
-                        for i in range(len(track) - 1):
-                            try:
-                                occurrences[tuple(track[i: i + 2])] += 1
-                            except KeyError:
-                                occurrences[tuple(track[i: i + 2])] = 1
-
-                to_replace = max(occurrences, key=occurrences.get)  # most recurrent succession of two tokens
-                to_replace_bis = []  # store non-BPE tokens to be registered in vocab
-                for token in to_replace:
-                    if self.vocab.token_to_event[token].split('_')[0] == 'BPE':
-                        to_replace_bis += map(int,
-                                              self.vocab.token_to_event[token].split('_')[1].split('.')[1].split('-'))
-                    else:
-                        to_replace_bis.append(token)
-                to_replace_str = '-'.join(map(str, to_replace)) + '.' + '-'.join(map(str, to_replace_bis))
-                self.vocab.add_event(Event(type_='BPE', time=0, value=to_replace_str, desc=''))
-                for sample in samples:  # replace in existing samples
-                    for track in sample['tokens']:
-                        i = 0
-                        while i < len(track) - 1:
-                            if tuple(track[i: i + 2]) == to_replace:
-                                track[i] = self.vocab[f'BPE_{to_replace_str}']
-                                del track[i + 1]
-                            i += 1
+                to_merge = _pop_most_frequent_pairs(heap, occurrences, count_repeated_pair,
+                                                    min(merges_per_iteration, vocab_size - len(self.vocab)))
+                if len(to_merge) == 0:  # every succession of tokens has been merged
+                    break
+                for to_replace_packed in to_merge:
+                    pbar.update(1)
+                    to_replace = _unpack_pair(to_replace_packed)
+                    # non-BPE tokens to be registered in vocab
+                    to_replace_bis = sum((self._bpe_to_children.get(token, (token,)) for token in to_replace), ())
+                    to_replace_str = '-'.join(map(str, to_replace)) + '.' + '-'.join(map(str, to_replace_bis))
+                    new_token = self.vocab.add_event(Event(type_='BPE', time=0, value=to_replace_str, desc=''))
+                    self._bpe_parent_pair[new_token] = to_replace
+                    self._bpe_to_children[new_token] = to_replace_bis
+                    _merge_pair(buffer, words_start, words_freq, occurrences, positions, heap, repeated_counts,
+                                to_replace_packed, new_token)
+
+            new_total_length = _total_length(buffer, words_start, words_freq)
+            del buffer, occurrences, positions, heap, repeated_counts
 
             # Saves dictionary and prints the difference in sequence length
             pbar.close()
@@ -98,60 +543,68 @@ def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
             self.set_bpe_tokens_successions()
             self.add_bpe_to_tokens_type_graph()
             self.vocab.update_token_types_indexes()
-            new_lengths = []
-            for sample, path in zip(samples, samples_paths):
-                if save_converted_samples:
-                    self.save_tokens(sample['tokens'], PurePath(out_dir, path).with_suffix(".json"), sample['programs'])
-                new_lengths += [len(track) for track in sample['tokens']]
+            if save_converted_samples:  # loads the samples again, and applies the learned merges
+                out_paths = [Path(out_dir, path.relative_to(tokens_path)).with_suffix('.json')
+                             for path in files_paths_bpe]
+                converted = _map(partial(_apply_bpe_to_file, self._bpe_merges), files_paths_bpe, out_paths,
+                                 nb_processes=nb_processes, chunksize=16)
+                for _ in tqdm(converted, desc='Saving converted samples', total=len(files_paths_bpe)):
+                    pass
             original_mean = sum(original_lengths) / len(original_lengths) if len(original_lengths) > 0. else 0.
-            new_mean = sum(new_lengths) / len(new_lengths) if len(new_lengths) > 0. else 0.
+            new_mean = new_total_length / len(original_lengths) if len(original_lengths) > 0. else 0.
             print(f'Mean of original lengths: {original_mean}\nMean length after BPE: {new_mean}')
             print(f'Variation from original: {(new_mean - original_mean) / original_mean * 100:.2f} %')
             self.save_params(out_dir)  # Saves the parameters with which the MIDIs are converted
+            return original_mean, new_mean
 
         def set_bpe_tokens_successions(self):
-            """Creates the bpe_successions attributes, as a dictionary of the form bpe_token: (tok1, tok2, tok3...)
+            """Creates the bpe_successions attributes, as a dictionary of the form bpe_token: (tok1, tok2, tok3...),
+            and the _bpe_merges attribute, as a dictionary of the form packed_pair: bpe_token (see _pack_pair).
+            The BPE tokens are parsed once from the vocabulary, to also store their parent tokens and
+            decomposition as integers (_bpe_parent_pair and _bpe_to_children attributes). The tokens
+            learned with the bpe method are already registered in these attributes, and are not parsed.
+            They are reset by load_params when it loads a vocabulary.
             """
-            self.bpe_successions = {tok: list(map(int, self.vocab.token_to_event[tok].split('_')[1].split('.')[0].
-                                                  split('-'))) for tok in self.vocab.tokens_of_type('BPE')}
+            for tok in self.vocab.tokens_of_type('BPE'):
+                if tok in self._bpe_parent_pair:
+                    continue
+                parents, children = self.vocab.token_to_event[tok].split('_')[1].split('.')
+                self._bpe_parent_pair[tok] = tuple(map(int, parents.split('-')))
+                self._bpe_to_children[tok] = tuple(map(int, children.split('-')))
+            self.bpe_successions = {tok: list(pair) for tok, pair in self._bpe_parent_pair.items()}
+            self._bpe_merges = {_pack_pair(*pair): tok for tok, pair in self._bpe_parent_pair.items()}
 
         def apply_bpe(self, tokens: List[int]) -> List[int]:
             r"""Converts a sequence of tokens into tokens with BPE.
+            The merges are applied by order of priority, i.e. in the same order they were learned.
 
             :param tokens: tokens to convert.
-            :return:
+            :return: the sequence of tokens with BPE
             """
             if not self.has_bpe:
                 return tokens
+            return _apply_merges(tokens, self._bpe_merges)
 
-            previous_len = len(tokens) + 1  # + 1 to fool when entering the loop
-            while previous_len != len(tokens):
-                previous_len = len(tokens)
-                # loop over BPE tokens from the vocabulary
-                for tok, token_succession in self.bpe_successions.items():
-                    i = 0  # will check if any token succession from the input token sequence matches the BPE
-                    while i <= len(tokens) - len(token_succession):
-                        if tokens[i:i + len(token_succession)] == token_succession:
-                            tokens[i] = tok  # if so, will replace the current token and remove the next ones to replace
-                            for _ in range(len(token_succession) - 1):
-                                del tokens[i + 1]
-                        i += 1
-            return tokens
-
-        def apply_bpe_to_dataset(self, dataset_path: Union[Path, PurePath, str], out_path: Union[Path, PurePath, str]):
+        def apply_bpe_to_dataset(self, dataset_path: Union[Path, PurePath, str], out_path: Union[Path, PurePath, str],
+                                 nb_processes: int = 1):
             r"""Apply BPE to an already tokenized dataset (with no BPE).
+            The files keep the same name and relative path in out_path.
 
             :param dataset_path: path to token files to load
             :param out_path: output directory to save
+            :param nb_processes: number of processes used to convert the files (default: 1)
             """
+            assert isinstance(nb_processes, int) and nb_processes >= 1, \
+                f'nb_processes ({nb_processes}) need to be an integer of at least 1'
             if not self.has_bpe:
                 return
 
             files_paths = list(Path(dataset_path).glob('**/*.json'))
-            for path in tqdm(files_paths, desc='Applying BPE to dataset'):
-                sample = self.load_tokens(path)
-                sample_bpe = [self.apply_bpe(track) for track in sample['tokens']]
-                self.save_tokens(sample_bpe, Path(out_path) / path.relative_to(dataset_path), sample['programs'])
+            out_paths = [Path(out_path, path.relative_to(dataset_path)) for path in files_paths]
+            converted = _map(partial(_apply_bpe_to_file, self._bpe_merges), files_paths, out_paths,
+                             nb_processes=nb_processes, chunksize=16)
+            for _ in tqdm(converted, desc='Applying BPE to dataset', total=len(files_paths)):
+                pass
 
         def midi_to_tokens(self, midi: MidiFile, *args_, **kwargs_) -> List[List[int]]:
             r"""First convert the MIDI into "regular" tokens, then apply BPE.
@@ -175,18 +628,22 @@ def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
         def decompose_bpe(self, tokens: List[int]) -> List[int]:
             r"""Decomposes a sequence of tokens containing BP encoded tokens into "prime" tokens.
 
+            The given sequence is not modified, non-BPE tokens being copied as is in a new list.
+
             :param tokens: token sequence to decompose
             :return: decomposed token sequence
             """
-            i = 0
-            while i < len(tokens):
-                token_type, token_val = self.vocab[tokens[i]].split('_')
-                if token_type == 'BPE':
-                    del tokens[i]
-                    for j, to_insert in enumerate(map(int, token_val.split('.')[1].split('-'))):
-                        tokens.insert(i + j, to_insert)
-                i += 1
-            return tokens
+            if not self.has_bpe:
+                return tokens
+            bpe_to_children = self._bpe_to_children
+            decomposed = []
+            append, extend = decomposed.append, decomposed.extend
+            for token in tokens:
+                if token in bpe_to_children:
+                    extend(bpe_to_children[token])
+                else:
+                    append(token)
+            return decomposed
 
         def token_types_errors(self, tokens: List[int], consider_pad: bool = False) -> float:
             r"""Checks if a sequence of tokens is constituted of good token types
@@ -222,15 +679,15 @@ def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
             """
             from inspect import getmro
             Path(out_dir).mkdir(parents=True, exist_ok=True)
-            with open(PurePath(out_dir, 'config').with_suffix(".txt"), 'w') as outfile:
-                json.dump({'pitch_range': (self.pitch_range.start, self.pitch_range.stop),
-                           'beat_res': {f'{k1}_{k2}': v for (k1, k2), v in self.beat_res.items()},
-                           'nb_velocities': len(self.velocities),
-                           'additional_tokens': self.additional_tokens,
-                           '_sos_eos': self._sos_eos,
-                           '_mask': self._mask,
-                           'encoding': f'{getmro(self.__class__)[1].__name__}_bpe',
-                           'token_to_event': self.vocab.token_to_event}, outfile, indent=4)
+            _save_json({'pitch_range': (self.pitch_range.start, self.pitch_range.stop),
+                        'beat_res': {f'{k1}_{k2}': v for (k1, k2), v in self.beat_res.items()},
+                        'nb_velocities': len(self.velocities),
+                        'additional_tokens': self.additional_tokens,
+                        '_sos_eos': self._sos_eos,
+                        '_mask': self._mask,
+                        'encoding': f'{getmro(self.__class__)[1].__name__}_bpe',
+                        'token_to_event': self.vocab.token_to_event},
+                       PurePath(out_dir, 'config').with_suffix(".txt"), indent=True)
 
         def load_params(self, params: Union[str, Path, PurePath, Dict[str, Any]]):
             r"""Loads parameters and set the encoder attributes.
@@ -238,8 +695,7 @@ def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
             :param params: can be a path to the parameter (json encoded) file or a dictionary
             """
             if isinstance(params, (str, Path, PurePath)):
-                with open(params) as param_file:
-                    params = json.load(param_file)
+                params = _load_json(params)
 
             if not isinstance(params['pitch_range'], range):
                 params['pitch_range'] = range(*params['pitch_range'])
@@ -257,6 +713,9 @@ def bpe(tokenizer: Type[MIDITokenizer], *args, **kwargs):
                     self.vocab._event_to_token = {event: int(token) for token, event in value.items()}
                     self.vocab.update_token_types_indexes()
                     self.has_bpe = len(self.vocab.tokens_of_type('BPE')) > 0
+                    # The BPE tokens of the previous vocabulary are dropped, to be parsed from the new one
+                    self._bpe_parent_pair, self._bpe_to_children = {}, {}
+                    self.bpe_successions, self._bpe_merges = {}, {}
                     continue
                 setattr(self, key, value)
 
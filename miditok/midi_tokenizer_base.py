@@ -163,7 +163,8 @@ class MIDITokenizer(ABC):
         :param events: list of Events objects to convert
         :return: list of corresponding tokens
         """
-        return [self.vocab.event_to_token[str(event)] for event in events]
+        event_to_token = self.vocab.event_to_token
+        return [event_to_token[str(event)] for event in events]
 
     def tokens_to_events(self, tokens: List[Union[int, List[int]]], multi_voc: bool = None) \
             -> List[Union[Event, List[Event]]]:
@@ -186,8 +187,9 @@ class MIDITokenizer(ABC):
                     multi_event.append(Event(name, None, val, None))
                 events.append(multi_event)
         else:
+            token_to_event = self.vocab.token_to_event
             for token in tokens:
-                name, val = self.vocab.token_to_event[token].split('_')
+                name, val = token_to_event[token].split('_')
                 events.append(Event(name, None, val, None))
         return events
 
@@ -545,19 +547,15 @@ class MIDITokenizer(ABC):
         :return: the error ratio (lower is better)
         """
         err = 0
-        previous_type = self.vocab.token_type(tokens[0])
-        if consider_pad:
-            for token in tokens[1:]:
-                if self.vocab.token_type(token) not in self.tokens_types_graph[previous_type]:
-                    err += 1
-                previous_type = self.vocab.token_type(token)
-        else:
-            for token in tokens[1:]:
-                if previous_type == 'PAD':  # stop iteration at the first PAD token
-                    break
-                if self.vocab.token_type(token) not in self.tokens_types_graph[previous_type]:
-                    err += 1
-                previous_type = self.vocab.token_type(token)
+        token_to_event, types_graph = self.vocab.token_to_event, self.tokens_types_graph
+        previous_type = token_to_event[tokens[0]].split('_')[0]
+        for token in tokens[1:]:
+            if not consider_pad and previous_type == 'PAD':  # stop iteration at the first PAD token
+                break
+            token_type = token_to_event[token].split('_')[0]
+            if token_type not in types_graph[previous_type]:
+                err += 1
+            previous_type = token_type
         return err / len(tokens)
 
     @staticmethod
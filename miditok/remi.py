@@ -282,16 +282,17 @@ class REMI(MIDITokenizer):
         :return: the error ratio (lower is better)
         """
         err = 0
-        previous_type = self.vocab.token_type(tokens[0])
+        token_to_event, types_graph = self.vocab.token_to_event, self.tokens_types_graph
+        previous_type = token_to_event[tokens[0]].split('_')[0]
         current_pos = -1
         current_pitches = []
 
         def check(tok: int):
             nonlocal err, previous_type, current_pos, current_pitches
-            token_type, token_value = self.vocab.token_to_event[tok].split('_')
+            token_type, token_value = token_to_event[tok].split('_')
 
             # Good token type
-            if token_type in self.tokens_types_graph[previous_type]:
+            if token_type in types_graph[previous_type]:
                 if token_type == 'Bar':  # reset
                     current_pos = -1
                     current_pitches = []
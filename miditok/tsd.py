@@ -253,16 +253,17 @@ class TSD(MIDITokenizer):
         :return: the error ratio (lower is better)
         """
         err = 0
-        previous_type = self.vocab.token_type(tokens[0])
+        token_to_event, types_graph = self.vocab.token_to_event, self.tokens_types_graph
+        previous_type, previous_value = token_to_event[tokens[0]].split('_')
         current_pitches = []
         if previous_type == 'Pitch':
-            current_pitches.append(int(self.vocab[tokens[0]].split('_')[1]))
+            current_pitches.append(int(previous_value))
 
         def check(tok: int):
             nonlocal err, previous_type, current_pitches
-            token_type, token_value = self.vocab.token_to_event[tok].split('_')
+            token_type, token_value = token_to_event[tok].split('_')
             # Good token type
-            if token_type in self.tokens_types_graph[previous_type]:
+            if token_type in types_graph[previous_type]:
                 if token_type == 'Pitch':
                     if int(token_value) in current_pitches:
                         err += 1  # pitch already being played
@@ -299,10 +300,11 @@ class TSD(MIDITokenizer):
         err_type = 0
         err_note = 0
         current_pitches = []
+        token_to_event, types_graph = self.vocab.token_to_event, self.tokens_types_graph
 
         for x_tok, y_tok in zip(x_tokens, y_tokens):
-            x_type, x_value = self.vocab.token_to_event[x_tok].split('_')
-            y_type, y_value = self.vocab.token_to_event[y_tok].split('_')
+            x_type, x_value = token_to_event[x_tok].split('_')
+            y_type, y_value = token_to_event[y_tok].split('_')
             if x_type == 'PAD':
                 break
 
@@ -312,7 +314,7 @@ class TSD(MIDITokenizer):
                 current_pitches = []  # moving in time, list reset
 
             # Good token type
-            if y_type in self.tokens_types_graph[x_type]:
+            if y_type in types_graph[x_type]:
                 if y_type == 'Pitch' and int(y_value) in current_pitches:
                     err_note += 1  # pitch already being played
             # Bad token type
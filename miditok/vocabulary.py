@@ -2,7 +2,7 @@
 
 """
 
-from typing import List, Tuple, Dict, Union, Generator
+from typing import List, Tuple, Dict, Union, Generator, Optional
 
 
 class Event:
@@ -58,12 +58,13 @@ class Vocabulary:
         if sos_eos:
             self.__add_sos_eos()
 
-    def add_event(self, event: Union[Event, str, Generator], index: int = None):
+    def add_event(self, event: Union[Event, str, Generator], index: int = None) -> Optional[int]:
         r"""Adds one or multiple entries to the vocabulary.
 
         :param event: event to add, either as an Event object or string of the form "Type_Value", e.g. Pitch_80
         :param index: (optional) index to set this event, if not given it will be set to last
                         Will be ignored if you give a generator as first arg
+        :return: the index (token) of the added event, or None if a generator was given
         """
         if isinstance(event, Generator):
             while True:
@@ -72,13 +73,14 @@ class Vocabulary:
                 except StopIteration:
                     return
         else:
-            self.__add_distinct_event(str(event), index)
+            return self.__add_distinct_event(str(event), index)
 
-    def __add_distinct_event(self, event: str, index: int = None):
+    def __add_distinct_event(self, event: str, index: int = None) -> int:
         r"""Private: Adds an event to the vocabulary.
 
         :param event: event to add, as a formatted string of the form "Type_Value", e.g. Pitch_80
         :param index: (optional) index to set this event, if not given it will be set to last
+        :return: the index (token) of the added event
         """
         if index is not None:
             if index in self._token_to_event:  # first checks if index is already used
@@ -99,6 +101,7 @@ class Vocabulary:
             self._token_types_indexes[event_type].append(index)
         else:
             self._token_types_indexes[event_type] = [index]
+        return index
 
     def token_type(self, token: int) -> str:
         r"""Returns the type of the given token.
@@ -28,6 +28,9 @@ setup(
         'miditoolkit>=0.1.16',
         'tqdm'
     ],
+    extras_require={
+        'fast': ['orjson'],  # faster reading / writing of token files with BPE
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Intended Audience :: Science/Research',
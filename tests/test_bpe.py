@@ -13,9 +13,11 @@ NOTE: encoded tracks has to be compared with the quantized original track.
 from copy import deepcopy
 from pathlib import Path, PurePath
 from typing import Union
+from importlib import import_module
 import json
 
 import miditok
+from miditok.bpe import _words_to_buffer, _count_repeated_pair, _pack_pair, _total_length, _MERGED
 from miditoolkit import MidiFile
 from tqdm import tqdm
 
@@ -31,6 +33,42 @@ ADDITIONAL_TOKENS_TEST = {'Chord': False,  # set to false to speed up tests as i
                           'nb_tempos': 32,
                           'tempo_range': (40, 250),
                           'time_signature_range': (16, 2)}
+# Synthetic tracks with runs of identical tokens, which pairs overlap
+SYNTHETIC_TRACKS = [[7] * 9 + [9, 9, 9] + [7] * 4, [7] * 5 + [8] * 6, [8] * 7 + [7, 7, 7], [5, 6] * 20 + [9]] * 20
+
+
+def naive_bpe(tracks, nb_merges: int, first_token: int):
+    r"""Naive reference of the BPE learning: at each step, the pairs of successive tokens are counted from
+    left to right, the successive identical tokens being counted without overlapping, and the most recurrent
+    pair is merged (the lowest one in case of equality).
+
+    :param tracks: token sequences to learn from
+    :param nb_merges: number of merges to learn
+    :param first_token: the first BPE token
+    :return: the learned merges, in order, and the tracks with BPE
+    """
+    tracks = [list(track) for track in tracks]
+    merges = []
+    for new_token in range(first_token, first_token + nb_merges):
+        counts = {}
+        for track in tracks:
+            last_position = {}  # position of the last counted occurrence of each pair
+            for i, pair in enumerate(zip(track, track[1:])):
+                if last_position.get(pair) == i - 1:  # overlaps with the previous one (identical tokens)
+                    continue
+                counts[pair] = counts.get(pair, 0) + 1
+                last_position[pair] = i
+        if len(counts) == 0:
+            break
+        best = max(counts, key=lambda pair_: (counts[pair_], -_pack_pair(*pair_)))
+        merges.append(best)
+        for track in tracks:
+            i = 0
+            while i < len(track) - 1:
+                if (track[i], track[i + 1]) == best:
+                    track[i:i + 2] = [new_token]
+                i += 1
+    return merges, tracks
 
 
 def test_bpe_conversion(data_path: Union[str, Path, PurePath] = './tests/Maestro_MIDIs'):
@@ -41,6 +79,7 @@ def test_bpe_conversion(data_path: Union[str, Path, PurePath] = './tests/Maestro
     :param data_path: root path to the data to test
     """
     encodings = ['Structured', 'REMI', 'MIDILike']
+    merges_per_iteration = {'Structured': 1, 'REMI': 3, 'MIDILike': 1}  # REMI also tests several merges / iteration
     tokenizers = []
     data_path = Path(data_path)
     files = list(data_path.glob('**/*.mid'))
@@ -50,13 +89,23 @@ def test_bpe_conversion(data_path: Union[str, Path, PurePath] = './tests/Maestro
         add_tokens = deepcopy(ADDITIONAL_TOKENS_TEST)
         tokenizers.append(miditok.bpe(getattr(miditok, encoding), beat_res=BEAT_RES_TEST, additional_tokens=add_tokens))
         tokenizers[-1].tokenize_midi_dataset(files, data_path / encoding)
-        tokenizers[-1].bpe(data_path / encoding, len(tokenizers[-1].vocab) + 120, out_dir=data_path / f'{encoding}_bpe',
-                           files_lim=None, save_converted_samples=True)
+        vocab_size = len(tokenizers[-1].vocab) + 120
+        _, learned_mean = tokenizers[-1].bpe(data_path / encoding, vocab_size, out_dir=data_path / f'{encoding}_bpe',
+                                             files_lim=None, save_converted_samples=True, nb_processes=2,
+                                             merges_per_iteration=merges_per_iteration[encoding])
+        assert len(tokenizers[-1].vocab) == vocab_size
+        # The mean length after BPE is computed from the learned sequences, the converted samples with apply_bpe
+        converted_lengths = []
+        for path in (data_path / f'{encoding}_bpe').glob('**/*.json'):
+            with open(path) as json_file:
+                converted_lengths += [len(track) for track in json.load(json_file)['tokens']]
+        assert learned_mean == sum(converted_lengths) / len(converted_lengths)
 
     # Reload (test) tokenizer from the saved config file
     tokenizers = []
     for i, encoding in enumerate(encodings):
         tokenizers.append(miditok.bpe(getattr(miditok, encoding), params=data_path / f'{encoding}_bpe' / 'config.txt'))
+        tokenizers[-1].apply_bpe_to_dataset(data_path / encoding, data_path / f'{encoding}_bpe_dataset', nb_processes=2)
 
     at_least_one_error = False
 
@@ -73,7 +122,9 @@ def test_bpe_conversion(data_path: Union[str, Path, PurePath] = './tests/Maestro
             with open(data_path / f'{encoding}_bpe' / f'{file_path.stem}.json') as json_file:
                 saved_tokens = json.load(json_file)['tokens'][0]  # with BPE, saved after creating vocab
             saved_tokens_decomposed = tokenizer.decompose_bpe(deepcopy(saved_tokens))
-            no_error_bpe = tokens == saved_tokens
+            with open(data_path / f'{encoding}_bpe_dataset' / f'{file_path.stem}.json') as json_file:
+                dataset_tokens = json.load(json_file)['tokens'][0]  # with BPE, applied to the tokenized dataset
+            no_error_bpe = tokens == saved_tokens == dataset_tokens
             no_error = tokens_no_bpe == tokens_no_bpe2 == saved_tokens_decomposed
             if not no_error or not no_error_bpe:
                 at_least_one_error = True
@@ -81,5 +132,71 @@ def test_bpe_conversion(data_path: Union[str, Path, PurePath] = './tests/Maestro
     assert not at_least_one_error
 
 
+def test_bpe_repeated_tokens(data_path: Union[str, Path, PurePath] = './tests/Maestro_MIDIs'):
+    r"""Checks that pairs of identical tokens are counted without overlapping, and that the learned
+    merges are the same as with a naive reference on tracks with runs of identical tokens.
+
+    :param data_path: root path to the data to test
+    """
+    buffer, words_start = _words_to_buffer([(1, 1, 1, 1), (1, 1, 1), (2, 1, 1)])
+    positions = {_pack_pair(1, 1): {1, 2, 3, 6, 7, 11}}
+    assert _count_repeated_pair(buffer, words_start, [1, 1, 3], positions, {}, _pack_pair(1, 1)) == 2 + 1 + 3
+    # (1, 1) at 1 covers the 1 at 3, after a merged token (tombstone), so (1, 1) at 3 cannot be merged
+    buffer, words_start = _words_to_buffer([(1, 0, 1, 1)])
+    buffer[2] = _MERGED
+    positions = {_pack_pair(1, 1): {1, 3}}
+    assert _count_repeated_pair(buffer, words_start, [5], positions, {}, _pack_pair(1, 1)) == 5
+    assert _total_length(buffer, words_start, [5]) == 3 * 5  # the merged token is not counted
+
+    data_path = Path(data_path, 'BPE_synthetic')
+    data_path.mkdir(parents=True, exist_ok=True)
+    with open(data_path / 'synthetic.json', 'w') as outfile:
+        json.dump({'tokens': SYNTHETIC_TRACKS, 'programs': []}, outfile)
+    tokenizer = miditok.bpe(miditok.MIDILike, beat_res=BEAT_RES_TEST, additional_tokens=deepcopy(ADDITIONAL_TOKENS_TEST))
+    first_token = len(tokenizer.vocab)
+    merges, tracks_bpe = naive_bpe(SYNTHETIC_TRACKS, 20, first_token)
+    tokenizer.bpe(data_path, first_token + 20, out_dir=data_path.parent / 'BPE_synthetic_bpe',
+                  save_converted_samples=True)
+    assert [tokenizer._bpe_parent_pair[token] for token in range(first_token, len(tokenizer.vocab))] == merges
+    with open(data_path.parent / 'BPE_synthetic_bpe' / 'synthetic.json') as json_file:
+        assert json.load(json_file)['tokens'] == tracks_bpe  # merges applied in order as when learning
+
+
+def test_bpe_json_without_orjson(data_path: Union[str, Path, PurePath] = './tests/Maestro_MIDIs'):
+    r"""Checks that token files and BPE configs are saved and loaded without orjson, and if it is
+    installed that the files are the same with and without it.
+
+    :param data_path: root path to the data to test
+    """
+    bpe_module = import_module('miditok.bpe')  # miditok.bpe is the bpe function
+    orjson = bpe_module.orjson
+    data_path = Path(data_path, 'BPE_json')
+    data_path.mkdir(parents=True, exist_ok=True)
+    with open(data_path / 'synthetic.json', 'w') as outfile:
+        json.dump({'tokens': SYNTHETIC_TRACKS, 'programs': []}, outfile)
+    tokenizer = miditok.bpe(miditok.MIDILike, beat_res=BEAT_RES_TEST, additional_tokens=deepcopy(ADDITIONAL_TOKENS_TEST))
+    tokenizer.bpe(data_path, len(tokenizer.vocab) + 10, out_dir=data_path.parent / 'BPE_json_bpe')
+    sample = {'tokens': [tokenizer.apply_bpe(track) for track in SYNTHETIC_TRACKS], 'programs': []}
+
+    files = {}
+    try:
+        for name, module in (('orjson', orjson), ('json', None)):
+            if name == 'orjson' and orjson is None:
+                continue
+            bpe_module.orjson = module
+            out_path = data_path.parent / f'BPE_json_{name}'
+            tokenizer.save_params(out_path)
+            bpe_module._save_json(sample, out_path / 'tokens.json')
+            assert bpe_module._load_json(out_path / 'tokens.json') == sample
+            assert miditok.bpe(miditok.MIDILike, params=out_path / 'config.txt')._bpe_merges == tokenizer._bpe_merges
+            files[name] = [(out_path / file_name).read_bytes() for file_name in ('config.txt', 'tokens.json')]
+    finally:
+        bpe_module.orjson = orjson
+    if 'orjson' in files:
+        assert files['orjson'] == files['json']
+
+
 if __name__ == "__main__":
     test_bpe_conversion()
+    test_bpe_repeated_tokens()
+    test_bpe_json_without_orjson()